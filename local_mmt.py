@@ -1,75 +1,453 @@
+import os
+import threading
 import cv2
 import numpy  as np
-from skimage.feature import peak_local_max
+from collections        import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses        import dataclass
 from scipy.signal    import find_peaks
 
+try:
+    from numba import njit
+except ImportError: # numba is optional, the NMS kernel then runs as plain python
+    def njit(*args, **kwargs):
+        return lambda function: function
+
 # from .NMS import NMS
 
 # __all__ = ['NMS']
 # __version__ = '1.5.3'
 
+@dataclass(eq=False) # the generated __eq__ would compare arrays, and raise
+class Hits:
+    '''
+    Hits of a template search, stored as one array per field rather than one row per hit
+    - names  : (N,) object array, label of the template
+    - bboxes : (N,4) int32 array, bounding box (X, Y, Width, Height)
+    - scores : (N,) float32 array, matching score
+    '''
+    names  : np.ndarray
+    bboxes : np.ndarray
+    scores : np.ndarray
+    
+    def __post_init__(self):
+        # Fixed dtypes, whatever the input : no object or float64 array reaches the thresholding, sorting and NMS
+        # float32 scores are exact for the score maps of OpenCV (computed in float32) and halve the memory traffic of float64
+        # float16 is not used : its 11-bit mantissa would tie near-equal scores, and change which box the NMS keeps
+        self.names  = np.asarray(self.names,  dtype=object).reshape(-1)
+        self.bboxes = np.asarray(self.bboxes, dtype=np.int32).reshape(-1, 4)
+        self.scores = np.asarray(self.scores, dtype=np.float32).reshape(-1)
+    
+    def __len__(self):
+        return len(self.scores)
+    
+    def __getitem__(self, index):
+        '''Select hits with an index, a slice, a boolean mask or an array of index, applied alike to the 3 arrays'''
+        if isinstance(index, (int, np.integer)): # a single hit is still Hits with 1 element
+            index = [index]
+        
+        return Hits(self.names[index], self.bboxes[index], self.scores[index])
+    
+    @classmethod
+    def concatenate(cls, listHits):
+        '''Gather a list of Hits into a single one'''
+        if not listHits:
+            return cls(np.empty(0, dtype=object), np.empty((0,4), dtype=np.int32), np.empty(0, dtype=np.float32))
+        
+        return cls(np.concatenate([hits.names  for hits in listHits]),
+                   np.concatenate([hits.bboxes for hits in listHits]),
+                   np.concatenate([hits.scores for hits in listHits]))
+
+# Template matching on the GPU, if OpenCV was built with the CUDA modules and a device is available
+_useCuda      = hasattr(cv2, "cuda") and hasattr(cv2.cuda, "createTemplateMatching") and cv2.cuda.getCudaEnabledDeviceCount() > 0
+
+# Score maps larger than this (16 MB in float32) are computed in strips of rows, see _iterScoreStrips_
+_maxScorePixels = 2048*2048
+
+# CUDA matchers of each thread, since the templates are searched in parallel
+_threadLocal = threading.local()
+
+# Score map buffers free for reuse, shared by all threads, least recently used first
+# At most 2 buffers and 64 MB are kept between searches, whatever the number of threads
+_freeBuffers     = OrderedDict() # (height, width) -> buffer
+_freeBuffersLock = threading.Lock()
+_maxFreeBuffers  = 2
+_maxFreeBytes    = 64 * 2**20
+
+# Threads searching the templates in parallel, kept from one call to the next (they hold no score buffer, see _takeBuffer_)
+_executor        = None
+_executorWorkers = 0 # number of threads of _executor
+_executorLock    = threading.Lock()
+
+def _getExecutor_():
+    '''
+    Return the executor searching the templates in parallel, or None for a sequential search
+    cv2.matchTemplate already runs on cv2.getNumThreads() threads, so the templates only use the remaining CPUs
+    ie the search is sequential by default, and parallel over the templates after cv2.setNumThreads(1)
+    The executor is created once, and only replaced if the OpenCV number of threads changed
+    '''
+    global _executor, _executorWorkers
+    
+    N_workers = max(1, (os.cpu_count() or 1) // max(1, cv2.getNumThreads()))
+    
+    with _executorLock:
+        if N_workers == 1:
+            return None
+        
+        if _executor is None or _executorWorkers != N_workers:
+            # The replaced executor is not shut down, another thread may be about to use it
+            # its threads exit once it is garbage collected, ie after the last search using it
+            _executor        = ThreadPoolExecutor(max_workers=N_workers, thread_name_prefix="local_mmt")
+            _executorWorkers = N_workers
+        
+        return _executor
+
+def _boundingBox_(mask):
+    '''
+    Return the (rows, columns) slices of the bounding box of the True pixels of a 2D mask (with at least one True pixel)
+    The box is enlarged by 1 pixel on each side (within the mask), so that every pixel in it has its full 3x3 neighbourhood
+    '''
+    rows = np.flatnonzero(mask.any(axis=1))
+    cols = np.flatnonzero(mask.any(axis=0))
+    
+    return slice(max(rows[0]-1, 0), rows[-1]+2), slice(max(cols[0]-1, 0), cols[-1]+2)
+
+
 def _findLocalMax_(corrMap, score_threshold=0.6):
     '''
     Get coordinates of the local maximas with values above a threshold in the image of the correlation map
+    Return a (K,2) integer array of (row, column)
     '''
     
     # IF depending on the shape of the correlation map
     if corrMap.shape == (1,1): ## Template size = Image size -> Correlation map is a single digit')
         
         if corrMap[0,0]>=score_threshold:
-            Peaks = np.array([[0,0]])
+            Peaks = np.zeros((1,2), dtype=np.intp)
         else:
-            Peaks = []
+            Peaks = np.zeros((0,2), dtype=np.intp)
 
     # use scipy findpeaks for the 1D cases (would allow to specify the relative threshold for the score directly here rather than in the NMS
     elif corrMap.shape[0] == 1:     ## Template is as high as the image, the correlation map is a 1D-array
         Peaks = find_peaks(corrMap[0], height=score_threshold) # corrMap[0] to have a proper 1D-array
-        Peaks = [[0,i] for i in Peaks[0]] # 0,i since one coordinate is fixed (the one for which Template = Image)
+        Peaks = np.column_stack([np.zeros_like(Peaks[0]), Peaks[0]]) # 0,i since one coordinate is fixed (the one for which Template = Image)
         
 
     elif corrMap.shape[1] == 1: ## Template is as wide as the image, the correlation map is a 1D-array
         #Peaks    = argrelmax(corrMap, mode="wrap")
         Peaks = find_peaks(corrMap[:,0], height=score_threshold)
-        Peaks = [[i,0] for i in Peaks[0]]
+        Peaks = np.column_stack([Peaks[0], np.zeros_like(Peaks[0])])
 
 
     else: # Correlatin map is 2D
-        Peaks = peak_local_max(corrMap, threshold_abs=score_threshold, exclude_border=False).tolist()
+        aboveThreshold = corrMap > score_threshold
+        
+        if not aboveThreshold.any(): return np.zeros((0,2), dtype=np.intp) # most strips have no candidate at all
+        
+        # local maxima are equal to the max of their 3x3 neighbourhood, ie to the dilated map (OpenCV dilate is SIMD-vectorized)
+        # only computed within the bounding box of the pixels above the threshold
+        rows, cols = _boundingBox_(aboveThreshold)
+        subMap = corrMap[rows, cols]
+        isPeak = (subMap == cv2.dilate(subMap, None)) & aboveThreshold[rows, cols]
+        Peaks  = np.argwhere(isPeak) + (rows.start, cols.start)
 
     return Peaks
 
 
 
 def _findLocalMin_(corrMap, score_threshold=0.4):
-    '''Find coordinates of local minimas with values below a threshold in the image of the correlation map'''
-    return _findLocalMax_(-corrMap, -score_threshold)
+    '''
+    Find coordinates of local minimas with values below a threshold in the image of the correlation map, as a (K,2) integer array of (row, column)
+    Same dispatch as _findLocalMax_, but without allocating a negated copy of the correlation map for the 2D case
+    '''
+    
+    # IF depending on the shape of the correlation map
+    if corrMap.shape == (1,1): ## Template size = Image size -> Correlation map is a single digit')
+        
+        if corrMap[0,0]<=score_threshold:
+            Peaks = np.zeros((1,2), dtype=np.intp)
+        else:
+            Peaks = np.zeros((0,2), dtype=np.intp)
+
+    # scipy findpeaks only looks for maxima, the negated line is a small temporary array
+    elif corrMap.shape[0] == 1:     ## Template is as high as the image, the correlation map is a 1D-array
+        Peaks = find_peaks(-corrMap[0], height=-score_threshold) # corrMap[0] to have a proper 1D-array
+        Peaks = np.column_stack([np.zeros_like(Peaks[0]), Peaks[0]]) # 0,i since one coordinate is fixed (the one for which Template = Image)
+        
+
+    elif corrMap.shape[1] == 1: ## Template is as wide as the image, the correlation map is a 1D-array
+        Peaks = find_peaks(-corrMap[:,0], height=-score_threshold)
+        Peaks = np.column_stack([Peaks[0], np.zeros_like(Peaks[0])])
 
 
-def computeScoreMap(template, image, method=cv2.TM_CCOEFF_NORMED):
+    else: # Correlatin map is 2D
+        belowThreshold = corrMap < score_threshold
+        
+        if not belowThreshold.any(): return np.zeros((0,2), dtype=np.intp)
+        
+        # local minima are equal to the min of their 3x3 neighbourhood, ie to the eroded map
+        rows, cols = _boundingBox_(belowThreshold)
+        subMap = corrMap[rows, cols]
+        isPeak = (subMap == cv2.erode(subMap, None)) & belowThreshold[rows, cols]
+        Peaks  = np.argwhere(isPeak) + (rows.start, cols.start)
+
+    return Peaks
+
+
+def computeScoreMap(template, image, method=cv2.TM_CCOEFF_NORMED, result=None):
     '''
     Compute score map provided numpy array for template and image.
     Automatically converts images if necessary
+    An optional float32 array of the score map size can be provided as result, to avoid allocating a new one
     return score map as numpy as array
     '''
     if template.dtype == "float64" or image.dtype == "float64": 
         raise ValueError("64-bit not supported, max 32-bit")
         
     # Convert images if not both 8-bit (OpenCV matchTempalte is only defined for 8-bit OR 32-bit)
+    # no copy for the arrays which are already 32-bit, like the templates returned by prepareTemplates
     if not (template.dtype == "uint8" and image.dtype == "uint8"):
-        template = np.float32(template)
-        image    = np.float32(image)
+        template = template.astype(np.float32, copy=False)
+        image    = image.astype(np.float32, copy=False)
+    
+    # Compute correlation map, in the preallocated result array if provided
+    return cv2.matchTemplate(template, image, method, result=result)
+
+
+def _computeScoreMapCuda_(template, imageGpu, method):
+    '''
+    Compute the score map on the GPU, for an image already uploaded as a cv2.cuda_GpuMat
+    The template should have the same type as the image, and be smaller than the image
+    Return the score map as a cv2.cuda_GpuMat, left on the GPU, or None if the CUDA module does not support this image type with this method (ex : 32-bit images are only supported for TM_SQDIFF and TM_CCORR)
+    '''
+    srcType = imageGpu.type()
+    
+    # one matcher per (image type, method) and per thread, None if not supported by the CUDA module
+    cudaMatchers = _threadLocal.__dict__.setdefault("cudaMatchers", {})
+    
+    if (srcType, method) not in cudaMatchers:
+        try:
+            cudaMatchers[srcType, method] = cv2.cuda.createTemplateMatching(srcType, method)
+        except cv2.error:
+            cudaMatchers[srcType, method] = None
+    
+    matcher = cudaMatchers[srcType, method]
+    if matcher is None: return None
+    
+    templateGpu = cv2.cuda_GpuMat()
+    templateGpu.upload(template)
+    
+    return matcher.match(imageGpu, templateGpu)
+
+
+def _takeBuffer_(height, width):
+    '''
+    Return a float32 buffer for a score map (or strip), taken from the free buffers if one has this size, else allocated
+    The buffer belongs to the caller until given back with _releaseBuffer_, so threads never share a buffer
+    The rows used are always overwritten by cv2.matchTemplate, so the buffer is not reset
+    '''
+    with _freeBuffersLock:
+        buffer = _freeBuffers.pop((height, width), None)
+    
+    return np.empty((height, width), dtype=np.float32) if buffer is None else buffer
+
+
+def _releaseBuffer_(buffer):
+    '''
+    Give back a buffer from _takeBuffer_, for the next templates and images of the same size
+    The least recently used buffers are dropped beyond _maxFreeBuffers buffers or _maxFreeBytes bytes
+    '''
+    with _freeBuffersLock:
+        _freeBuffers[buffer.shape] = buffer
+        _freeBuffers.move_to_end(buffer.shape)
+        
+        while len(_freeBuffers) > _maxFreeBuffers or sum(free.nbytes for free in _freeBuffers.values()) > _maxFreeBytes:
+            _freeBuffers.popitem(last=False)
+
+
+def _iterScoreStrips_(template, image, method, height, width, imageGpu=None):
+    '''
+    Compute the score map of a template in strips of full rows, such that no more than _maxScorePixels scores are held at once
+    Score maps within this budget (the usual case) are computed in a single call, without strips
+    
+    Each score is computed once : the last 2 rows of a strip are carried over to the next one, so that local extrema on the seam
+    are compared to the same score values than without strips. The scores of the strips can still differ from the untiled map
+    by float rounding, since OpenCV computes them on a smaller block of the image (up to ~1e-4 for the normalized methods)
+    
+    Yield for each strip (corrMap, yStrip, (rowStart, rowEnd), (ownStart, ownEnd)), with
+    - corrMap : scores of the strip, preceded by the rows carried over from the previous strip
+    - yStrip : row of corrMap[0] in the full score map
+    - rowStart, rowEnd : rows of corrMap whose local extrema are decided in this strip (all their neighbours are known)
+    - ownStart, ownEnd : rows of corrMap computed for this strip, ie not carried over
+    corrMap is a view of a buffer reused for the next strip (and the next search), it should not be kept
+    
+    If the image was uploaded to the GPU (imageGpu), the full score map is computed there when the CUDA module supports it
+    and downloaded by strips of rows within the same budget (the whole score map is only held in the GPU memory)
+    '''
+    scoreHeight = image.shape[0] - height + 1
+    scoreWidth  = image.shape[1] - width  + 1
+    
+    if scoreHeight<1 or scoreWidth<1: # Template larger than the image, OpenCV swaps them, no strips
+        corrMap = computeScoreMap(template, image, method)
+        yield corrMap, 0, (0, corrMap.shape[0]), (0, corrMap.shape[0])
+        return
+    
+    if imageGpu is not None and template.dtype == image.dtype:
+        corrGpu = _computeScoreMapCuda_(template, imageGpu, method)
+    else:
+        corrGpu = None
+    
+    def computeRows(yStart, yEnd, result):
+        '''Write the rows [yStart, yEnd) of the score map in result'''
+        if corrGpu is not None:
+            result[:] = corrGpu.rowRange(yStart, yEnd).download() # only these rows are transfered back
+        else:
+            computeScoreMap(template, image[yStart:yEnd+height-1], method, result=result)
+        
+        return result
+    
+    stripHeight = max(2, _maxScorePixels // scoreWidth)
+    
+    if scoreHeight <= stripHeight: # the full score map fits in the budget
+        buffer = _takeBuffer_(scoreHeight, scoreWidth)
+        try:
+            yield computeRows(0, scoreHeight, buffer), 0, (0, scoreHeight), (0, scoreHeight)
+        finally:
+            _releaseBuffer_(buffer)
+        return
+    
+    buffer   = _takeBuffer_(stripHeight+2, scoreWidth) # rows [0:2] for the rows carried over from the previous strip
+    nCarried = 0
+    
+    try:
+        for yStart in range(0, scoreHeight, stripHeight):
+            
+            yEnd = min(yStart+stripHeight, scoreHeight)
+            n    = yEnd - yStart
+            
+            # rows of full width are contiguous in the buffer
+            computeRows(yStart, yEnd, buffer[2:2+n])
+            corrMap = buffer[2-nCarried:2+n]
+            yStrip  = yStart - nCarried
+            
+            # The last row of the previous strip is decided now, the last row of this strip with the next one
+            rowStart = max(yStart-1, 0) - yStrip
+            rowEnd   = (yEnd if yEnd==scoreHeight else yEnd-1) - yStrip
+            
+            yield corrMap, yStrip, (rowStart, rowEnd), (nCarried, nCarried+n)
+            
+            buffer[0:2] = buffer[n:n+2] # n>=2 for all strips but the last
+            nCarried    = 2
+    finally:
+        _releaseBuffer_(buffer)
+
+
+def prepareTemplates(listTemplates):
+    '''
+    Convert the templates once, so that the same list can be reused to search many images
+    Templates are converted to 32-bit, except the 8-bit ones which OpenCV matches as such against 8-bit images
+    Parameters
+    ----------
+    - listTemplates : list of tuples (LabelString, Grayscale or RGB numpy array)
+    
+    Returns
+    -------
+    - list of tuples (LabelString, template, height, width), it can be passed as listTemplates to findMatches or matchTemplates
+      Tuples already prepared are kept as is
+    '''
+    listPrepared = []
+    for entry in listTemplates:
+        
+        if len(entry) == 4: # already prepared
+            listPrepared.append(entry)
+            continue
+        
+        templateName, template = entry
+        
+        if template.dtype == "float64": 
+            raise ValueError("64-bit not supported, max 32-bit")
+        
+        if template.dtype != "uint8":
+            template = np.float32(template)
+        
+        height, width = template.shape[0:2] # slicing make sure it works for RGB too
+        listPrepared.append( (templateName, template, height, width) )
+    
+    return listPrepared
+
+
+def _matchOne_(preparedTemplate, image, method, N_object, score_threshold, xOffset, yOffset, imageGpu):
+    '''
+    Search one template (as returned by prepareTemplates) in the image, see findMatches
+    Return the Hits of this template, before Non-Maxima Suppression
+    '''
+    templateName, template, height, width = preparedTemplate
+    
+    #print('\nSearch with template : ',templateName)
+    
+    # Search strip by strip, to never hold a large score map in memory
+    listPeaks, listScores = [], []
+    for corrMap, yStrip, (rowStart, rowEnd), (ownStart, ownEnd) in _iterScoreStrips_(template, image, method, height, width, imageGpu):
+        
+        ## Find possible location of the object 
+        if N_object==1: # Detect global Min/Max, within this strip for now
+            # Single pass of argmin or argmax on the contiguous rows computed for this strip, cv2.minMaxLoc would look for both
+            ownMap = corrMap[ownStart:ownEnd]
+            
+            if method==1:
+                index = np.argmin(ownMap) # opposite sorting than in the multiple detection
+            
+            elif method in (3,5):
+                index = np.argmax(ownMap)
+            
+            Peaks = np.array([np.unravel_index(index, ownMap.shape)]) + (ownStart, 0)
+            
+            
+        else:# Detect local max or min
+            if method==1: # Difference => look for local minima
+                Peaks = _findLocalMin_(corrMap, score_threshold)
+            
+            elif method in (3,5):
+                Peaks = _findLocalMax_(corrMap, score_threshold)
+            
+            # Peaks on the other rows are decided in the previous or next strip
+            Peaks = Peaks[(Peaks[:,0]>=rowStart) & (Peaks[:,0]<rowEnd)]
+        
+        listScores.append( corrMap[Peaks[:,0], Peaks[:,1]] ) # gather all scores at once, before the buffer is reused by the next strip
+        listPeaks.append( Peaks + (yStrip, 0) )              # coordinates in the full score map
+    
+    Peaks  = np.concatenate(listPeaks)
+    Scores = np.concatenate(listScores)
+    
+    if N_object==1: # Global Min/Max among the ones of every strip
+        best   = [np.argmin(Scores)] if method==1 else [np.argmax(Scores)]
+        Peaks  = Peaks[best]
+        Scores = Scores[best]
+    
+    #print('Initially found',len(Peaks),'hit with this template')
+    
+    
+    # Once every peak was detected for this given template
+    ## One array per field : names, bbox (x,y,Width, Height) and scores
+    
+    K = len(Peaks)
     
-    # Compute correlation map
-    return cv2.matchTemplate(template, image, method)
+    names  = np.full(K, templateName, dtype=object)
+    bboxes = np.column_stack([Peaks[:,1]+xOffset, Peaks[:,0]+yOffset, np.full(K, width), np.full(K, height)])
+    
+    return Hits(names, bboxes, Scores)
 
 
 def findMatches(listTemplates, image, method=cv2.TM_CCOEFF_NORMED, N_object=float("inf"), score_threshold=0.5, searchBox=None):
     '''
     Find all possible templates locations provided a list of template to search and an image
+    With the default OpenCV settings, cv2.matchTemplate already uses all the CPUs and the templates are searched one after the other
+    Call cv2.setNumThreads(1) to search the templates in parallel instead (one thread per CPU), which is faster for many small templates
     Parameters
     ----------
     - listTemplates : list of tuples (LabelString, Grayscale or RGB numpy array)
                     templates to search in each image, associated to a label 
+                    or list returned by prepareTemplates, to avoid converting the templates again for each image
     - image  : Grayscale or RGB numpy array
                image in which to perform the search, it should be the same bitDepth and number of channels than the templates
     - method : int 
@@ -83,7 +461,7 @@ def findMatches(listTemplates, image, method=cv2.TM_CCOEFF_NORMED, N_object=floa
     
     Returns
     -------
-    - Pandas DataFrame with 1 row per hit and column "TemplateName"(string), "BBox":(X, Y, Width, Height), "Score":float 
+    - Hits with arrays "names"(string), "bboxes":(X, Y, Width, Height), "scores":float, with 1 element per hit
     '''
     if N_object!=float("inf") and type(N_object)!=int:
         raise TypeError("N_object must be an integer")
@@ -98,48 +476,44 @@ def findMatches(listTemplates, image, method=cv2.TM_CCOEFF_NORMED, N_object=floa
     else:
         xOffset=yOffset=0
       
-    listHit = []
-    for templateName, template in listTemplates:
-        
-        #print('\nSearch with template : ',templateName)
-        
-        corrMap = computeScoreMap(template, image, method)
-
-        ## Find possible location of the object 
-        if N_object==1: # Detect global Min/Max
-            minVal, maxVal, minLoc, maxLoc = cv2.minMaxLoc(corrMap)
-            
-            if method==1:
-                Peaks = [minLoc[::-1]] # opposite sorting than in the multiple detection
-            
-            elif method in (3,5):
-                Peaks = [maxLoc[::-1]]
-            
-            
-        else:# Detect local max or min
-            if method==1: # Difference => look for local minima
-                Peaks = _findLocalMin_(corrMap, score_threshold)
-            
-            elif method in (3,5):
-                Peaks = _findLocalMax_(corrMap, score_threshold)
-            
-        
-        #print('Initially found',len(Peaks),'hit with this template')
-        
-        
-        # Once every peak was detected for this given template
-        ## Create a dictionnary for each hit with {'TemplateName':, 'BBox': (x,y,Width, Height), 'Score':coeff}
-        
-        height, width = template.shape[0:2] # slicing make sure it works for RGB too
-        
-        for peak in Peaks :
-            coeff  = corrMap[tuple(peak)]
-            newHit = [(templateName),  [ int(peak[1])+xOffset, int(peak[0])+yOffset, width, height ] , (coeff)]
-
-            # append to list of potential hit before Non maxima suppression
-            listHit.append(newHit)
+    if image.dtype == "float64": 
+        raise ValueError("64-bit not supported, max 32-bit")
+    
+    listPrepared = prepareTemplates(listTemplates)
+    
+    # Convert once here what computeScoreMap would otherwise convert for every template and strip
+    # OpenCV matches 8-bit templates in 8-bit images, everything else is matched in 32-bit
+    if image.dtype != "uint8":
+        image        = image.astype(np.float32, copy=False)
+        listPrepared = [(templateName, template.astype(np.float32, copy=False), height, width) for templateName, template, height, width in listPrepared]
     
-    return np.asarray(listHit) # All possible hits before Non-Maxima Supression
+    if any(template.dtype != image.dtype for _, template, _, _ in listPrepared): # 32-bit templates in a 8-bit image
+        imageFloat = np.float32(image)
+    else:
+        imageFloat = None
+    
+    # Upload the image to the GPU once for all templates
+    if _useCuda:
+        imageGpu = cv2.cuda_GpuMat()
+        imageGpu.upload(np.ascontiguousarray(image))
+    else:
+        imageGpu = None
+    
+    def searchTemplate(preparedTemplate):
+        if preparedTemplate[1].dtype == image.dtype:
+            return _matchOne_(preparedTemplate, image,      method, N_object, score_threshold, xOffset, yOffset, imageGpu)
+        else:
+            return _matchOne_(preparedTemplate, imageFloat, method, N_object, score_threshold, xOffset, yOffset, None)
+    
+    # Search the templates in parallel if OpenCV leaves CPUs idle, it releases the GIL while matching
+    executor = _getExecutor_() if len(listPrepared) > 1 else None
+    
+    if executor is not None:
+        listHit = list( executor.map(searchTemplate, listPrepared) )
+    else:
+        listHit = [searchTemplate(preparedTemplate) for preparedTemplate in listPrepared]
+    
+    return Hits.concatenate(listHit) # All possible hits before Non-Maxima Supression
     
 
 def matchTemplates(listTemplates, image, method=cv2.TM_CCOEFF_NORMED, N_object=float("inf"), score_threshold=0.5, maxOverlap=0.25, searchBox=None):
@@ -149,6 +523,7 @@ def matchTemplates(listTemplates, image, method=cv2.TM_CCOEFF_NORMED, N_object=f
     ----------
     - listTemplates : list of tuples (LabelString, Grayscale or RGB numpy array)
                     templates to search in each image, associated to a label 
+                    or list returned by prepareTemplates, to avoid converting the templates again for each image
     - image  : Grayscale or RGB numpy array
                image in which to perform the search, it should be the same bitDepth and number of channels than the templates
     - method : int 
@@ -165,7 +540,7 @@ def matchTemplates(listTemplates, image, method=cv2.TM_CCOEFF_NORMED, N_object=f
     
     Returns
     -------
-    Pandas DataFrame with 1 row per hit and column "TemplateName"(string), "BBox":(X, Y, Width, Height), "Score":float                 
+    List of bounding boxes [X, Y, Width, Height] of the best hits, sorted by score
         if N=1, return the best matches independently of the score_threshold
         if N<inf, returns up to N best matches that passed the score_threshold
         if N=inf, returns all matches that passed the score_threshold
@@ -182,6 +557,38 @@ def matchTemplates(listTemplates, image, method=cv2.TM_CCOEFF_NORMED, N_object=f
     return bestHits
 
 
+def _drawBoxes_(outImage, tableHit, boxColor, boxThickness):
+    '''
+    Draw in place all the bounding boxes of a list of hit with a single call to cv2.polylines
+    Each box is a closed contour through the 4 corners (x,y) (x+w,y) (x+w,y+h) (x,y+h), which gives the same pixels as cv2.rectangle
+    '''
+    if isinstance(tableHit, Hits): boxes = tableHit.bboxes # hits from findMatches
+    else:                          boxes = np.asarray(tableHit, dtype=np.int32).reshape(-1, 4) # bbox list from matchTemplates
+    
+    topLeft = boxes[:,[0,1]]
+    size    = boxes[:,[2,3]]
+    
+    if boxThickness<0: # filled boxes, cv2.fillPoly does not fill overlapping boxes the same way as cv2.rectangle
+        for x,y,w,h in boxes.tolist():
+            cv2.rectangle(outImage, (x, y), (x+w, y+h), color=boxColor, thickness=boxThickness)
+    
+    else:
+        contours = np.stack([topLeft, topLeft + size*[1,0], topLeft + size, topLeft + size*[0,1]], axis=1) # (N,4,2)
+        cv2.polylines(outImage, contours.astype(np.int32).reshape(-1, 4, 1, 2), isClosed=True, color=boxColor, thickness=boxThickness)
+
+
+def _drawLabels_(outImage, tableHit, labelColor, labelScale):
+    '''
+    Write in place the template name on top of each bounding box
+    Names are only known for the Hits returned by findMatches, nothing is written for a plain list of bbox
+    '''
+    if not isinstance(tableHit, Hits): return
+    
+    # iterate over plain python values rather than numpy scalars
+    for (x,y,w,h), name in zip(tableHit.bboxes.tolist(), tableHit.names.tolist()):
+        cv2.putText(outImage, text=str(name), org=(x, y), fontFace=cv2.FONT_HERSHEY_SIMPLEX, fontScale=labelScale, color=labelColor, lineType=cv2.LINE_AA) 
+
+
 def drawBoxesOnRGB(image, tableHit, boxThickness=2, boxColor=(255, 255, 00), showLabel=False, labelColor=(255, 255, 0), labelScale=0.5 ):
     '''
     Return a copy of the image with predicted template locations as bounding boxes overlaid on the image
@@ -208,10 +615,10 @@ def drawBoxesOnRGB(image, tableHit, boxThickness=2, boxColor=(255, 255, 00), sho
     if image.ndim == 2: outImage = cv2.cvtColor(image, cv2.COLOR_GRAY2RGB) # convert to RGB to be able to show detections as color box on grayscale image
     else:               outImage = image.copy()
         
-    for row in tableHit:
-        x,y,w,h = row
-        cv2.rectangle(outImage, (x, y), (x+w, y+h), color=boxColor, thickness=boxThickness)
-#         if showLabel: cv2.putText(outImage, text=row['TemplateName'], org=(x, y), fontFace=cv2.FONT_HERSHEY_SIMPLEX, fontScale=labelScale, color=labelColor, lineType=cv2.LINE_AA) 
+    # Draw all bounding boxes at once
+    _drawBoxes_(outImage, tableHit, boxColor, boxThickness)
+    
+    if showLabel: _drawLabels_(outImage, tableHit, labelColor, labelScale)
     
     return outImage
 
@@ -242,76 +649,77 @@ def drawBoxesOnGray(image, tableHit, boxThickness=2, boxColor=255, showLabel=Fal
     if image.ndim == 3: outImage = cv2.cvtColor(image, cv2.COLOR_RGB2GRAY) # convert to RGB to be able to show detections as color box on grayscale image
     else:               outImage = image.copy()
         
-    for index, row in tableHit.iterrows():
-        x,y,w,h = row['BBox']
-        cv2.rectangle(outImage, (x, y), (x+w, y+h), color=boxColor, thickness=boxThickness)
-        if showLabel: cv2.putText(outImage, text=row['TemplateName'], org=(x, y), fontFace=cv2.FONT_HERSHEY_SIMPLEX, fontScale=labelScale, color=labelColor, lineType=cv2.LINE_AA) 
+    # Draw all bounding boxes at once
+    _drawBoxes_(outImage, tableHit, boxColor, boxThickness)
+    
+    if showLabel: _drawLabels_(outImage, tableHit, labelColor, labelScale)
     
     return outImage
 
 
 
-def Point_in_Rectangle(Point, Rectangle):
-    '''Return True if a point (x,y) is contained in a Rectangle(x, y, width, height)'''
-    # unpack variables
-    Px, Py = Point
-    Rx, Ry, w, h = Rectangle
-
-    return (Rx <= Px) and (Px <= Rx + w -1) and (Ry <= Py) and (Py <= Ry + h -1) # simply test if x_Point is in the range of x for the rectangle 
+@njit(cache=True, nogil=True, fastmath=True)
+def _IoU_(Xleft1, Ytop1, Width1, Height1, Xleft2, Ytop2, Width2, Height2):
+    '''
+    Scalar IoU between 2 bounding boxes (x, y, width, height), for computeIoU and the NMS
+    The width/height of the intersection are clipped to 0 when the boxes do not overlap, and a box included within the other has an IoU of 1
+    '''
+    Inter_w = max(0, min(Xleft1 + Width1,  Xleft2 + Width2)  - max(Xleft1, Xleft2))
+    Inter_h = max(0, min(Ytop1  + Height1, Ytop2  + Height2) - max(Ytop1, Ytop2))
+    
+    Inter = Inter_w * Inter_h
+    
+    if Inter > 0 and Inter == min(Width1 * Height1, Width2 * Height2): # included box
+        return 1.0
+    
+    Union = Width1 * Height1 + Width2 * Height2 - Inter
+    
+    return 0.0 if Union <= 0 else Inter/Union
 
 
 def computeIoU(BBox1,BBox2):
     '''
-    Compute the IoU (Intersection over Union) between 2 rectangular bounding boxes defined by the top left (Xtop,Ytop) and bottom right (Xbot, Ybot) pixel coordinates
+    Compute the IoU (Intersection over Union) between 2 rectangular bounding boxes defined as (Xleft, Ytop, Width, Height)
+    A bounding box included within the other has an IoU of 1
     Code adapted from https://www.pyimagesearch.com/2016/11/07/intersection-over-union-iou-for-object-detection/
     '''
-    #print('BBox1 : ', BBox1)
-    #print('BBox2 : ', BBox2)
-    
-    # Unpack input (python3 - tuple are no more supported as input in function definition - PEP3113 - Tuple can be used in as argument in a call but the function will not unpack it automatically)
-    Xleft1, Ytop1, Width1, Height1 = BBox1
-    Xleft2, Ytop2, Width2, Height2 = BBox2
-    
-    # Compute bottom coordinates
-    Xright1 = Xleft1 + Width1  -1 # we remove -1 from the width since we start with 1 pixel already (the top one)
-    Ybot1    = Ytop1     + Height1 -1 # idem for the height
+    return _IoU_(*BBox1, *BBox2) # same kernel as the NMS
 
-    Xright2 = Xleft2 + Width2  -1
-    Ybot2    = Ytop2     + Height2 -1
 
-    # determine the (x, y)-coordinates of the top left and bottom right points of the intersection rectangle
-    Xleft  = max(Xleft1, Xleft2)
-    Ytop   = max(Ytop1, Ytop2)
-    Xright = min(Xright1, Xright2)
-    Ybot   = min(Ybot1, Ybot2)
-    
-    # Compute boolean for inclusion
-    BBox1_in_BBox2 = Point_in_Rectangle((Xleft1, Ytop1), BBox2) and Point_in_Rectangle((Xleft1, Ybot1), BBox2) and Point_in_Rectangle((Xright1, Ytop1), BBox2) and Point_in_Rectangle((Xright1, Ybot1), BBox2)
-    BBox2_in_BBox1 = Point_in_Rectangle((Xleft2, Ytop2), BBox1) and Point_in_Rectangle((Xleft2, Ybot2), BBox1) and Point_in_Rectangle((Xright2, Ytop2), BBox1) and Point_in_Rectangle((Xright2, Ybot2), BBox1) 
-    
-    # Check that for the intersection box, Xtop,Ytop is indeed on the top left of Xbot,Ybot
-    if BBox1_in_BBox2 or BBox2_in_BBox1:
-        #print('One BBox is included within the other')
-        IoU = 1
-    
-    elif Xright<Xleft or Ybot<Ytop : # it means that there is no intersection (bbox is inverted)
-        #print('No overlap')
-        IoU = 0 
-    
-    else:
-        # Compute area of the intersecting box
-        Inter = (Xright - Xleft + 1) * (Ybot - Ytop + 1) # +1 since we are dealing with pixels. See a 1D example with 3 pixels for instance
-        #print('Intersection area : ', Inter)
 
-        # Compute area of the union as Sum of the 2 BBox area - Intersection
-        Union = Width1 * Height1 + Width2 * Height2 - Inter
-        #print('Union : ', Union)
+@njit(cache=True, nogil=True, fastmath=True)
+def _greedyNMS_(bboxes, maxOverlap, N_max):
+    '''
+    Return a boolean mask of the bounding boxes kept by the greedy Non-Maxima Suppression
+    bboxes is a (N,4) array of (x, y, width, height) already sorted best first
+    Each kept box rejects the following boxes overlapping it too much, the masks are preallocated so nothing is copied in the loop
+    '''
+    N        = len(bboxes)
+    kept     = np.zeros(N, np.bool_)
+    rejected = np.zeros(N, np.bool_)
+    N_kept   = 0
+    
+    for i in range(N):
+        
+        if rejected[i]: continue
+        
+        kept[i] = True
+        N_kept += 1
         
-        # Compute Intersection over union
-        IoU = Inter/Union
+        if N_kept >= N_max: break
+        
+        Xleft1, Ytop1, Width1, Height1 = bboxes[i,0], bboxes[i,1], bboxes[i,2], bboxes[i,3]
+        
+        for j in range(i+1, N):
+            
+            if rejected[j]: continue
+            
+            Xleft2, Ytop2, Width2, Height2 = bboxes[j,0], bboxes[j,1], bboxes[j,2], bboxes[j,3]
+            
+            if _IoU_(Xleft1, Ytop1, Width1, Height1, Xleft2, Ytop2, Width2, Height2) > maxOverlap:
+                rejected[j] = True
     
-    #print('IoU : ',IoU)
-    return IoU
+    return kept
 
 
 
@@ -326,11 +734,10 @@ def NMS(tableHit, scoreThreshold=None, sortAscending=False, N_object=float("inf"
 
     Then the hit are ordered so that we have the best hits first.
     Then we iterate over the list of hits, taking one hit at a time and checking for overlap with the previous validated hit (the Final Hit list is directly iniitialised with the first best hit as there is no better hit with which to compare overlap)    
-    
-    This iteration is terminate once we have collected N best hit, or if there are no more hit left to test for overlap 
+    This iteration is terminate once we have collected N best hit, or if there are no more hit left to test for overlap (see _greedyNMS_)
    
    INPUT
-    - tableHit         : (Panda DataFrame) Each row is a hit, with columns "TemplateName"(String),"BBox"(x,y,width,height),"Score"(float)
+    - tableHit         : (Hits) as returned by findMatches, with arrays "names"(String),"bboxes"(x,y,width,height),"scores"(float)
                         
     - scoreThreshold : Float (or None), used to remove hit with too low prediction score. 
                        If sortDescending=True (ie we use a correlation measure so we want to keep large scores) the scores above that threshold are kept
@@ -341,19 +748,19 @@ def NMS(tableHit, scoreThreshold=None, sortAscending=False, N_object=float("inf"
     - sortAscending : use True when low score means better prediction (Difference-based score), True otherwise (Correlation score)
 
     OUTPUT
-    Panda DataFrame with best detection after NMS, it contains max N detection (but potentially less)
+    List of bounding boxes [x,y,width,height] of the best detection after NMS, it contains max N detection (but potentially less)
     '''
 #     print("shape of tableHit: {}".format(tableHit.shape))
     # Apply threshold on prediction score
     if scoreThreshold==None :
-        threshTable = tableHit.copy() # copy to avoid modifying the input list in place
+        threshTable = tableHit # the input is not modified in place, indexing below returns new arrays
     
     elif not sortAscending : # We keep rows above the threshold
-        threshTable = tableHit[ tableHit[:,2]>=scoreThreshold ]
+        threshTable = tableHit[ tableHit.scores>=scoreThreshold ]
         
 
     elif sortAscending : # We keep hit below the threshold
-        threshTable = tableHit[ tableHit[:,2]<=scoreThreshold ]    
+        threshTable = tableHit[ tableHit.scores<=scoreThreshold ]    
         
     
     # Sort score to have best predictions first (ie lower score if difference-based, higher score if correlation-based)
@@ -361,62 +768,20 @@ def NMS(tableHit, scoreThreshold=None, sortAscending=False, N_object=float("inf"
     
 
     if sortAscending:
-        threshTable = threshTable[threshTable[:,2].argsort()]
+        threshTable = threshTable[np.argsort(threshTable.scores)]
     elif not sortAscending:
-        threshTable = threshTable[threshTable[:,2].argsort()[::-1]]
+        threshTable = threshTable[np.argsort(threshTable.scores)[::-1]]
 
     
-    # Split the inital pool into Final Hit that are kept and restTable that can be tested
-    # Initialisation : 1st keep is kept for sure, restTable is the rest of the list
-    outTable  = threshTable[0:1,1] # double square bracket to recover a DataFrame
-    restTable = threshTable[1:len(threshTable),1]
+    if len(threshTable)==0: return []
     
-
-    # Loop to compute overlap
-    while (len(outTable))<N_object and len(restTable)>0: # second condition is restTable is not empty
-        
-       
-        # pick the next best peak in the rest of peak
-        testHit_dico = restTable[0:1] # dico
-        test_bbox = testHit_dico[0]
-     
-        # Loop over hit in outTable to compute successively overlap with testHit    
-        for hit_dico in outTable: 
-            
-
-            
-            # Recover Bbox from hit
-            bbox2 = hit_dico 
-
-            # Compute the Intersection over Union between test_peak and current peak
-            IoU = computeIoU(test_bbox, bbox2)
-            
-            # Initialise the boolean value to true before test of overlap
-            ToAppend = True 
+    # Greedy overlap test on the hits sorted best first, compiled with numba
+    N_max = len(threshTable) if N_object==float("inf") else min(N_object, len(threshTable))
     
-            if IoU>maxOverlap:
-                ToAppend = False
-               
-                break # no need to test overlap with the other peaks
-            
-            else:
-                
-                # no overlap for this particular (test_peak,peak) pair, keep looping to test the other (test_peak,peak)
-                continue
-      
-        
-        # After testing against all peaks (for loop is over), append or not the peak to final
-        if ToAppend:
-            # Move the test_hit from restTable to outTable
-           
-            outTable= np.append(outTable,testHit_dico)
-            restTable =np.delete(restTable, np.where(restTable == testHit_dico))
-
-            
-        else:
-
-            restTable =np.delete(restTable, np.where(restTable == testHit_dico))
+    kept = _greedyNMS_(threshTable.bboxes.astype(np.int64), maxOverlap, N_max) # boolean mask of kept hits
+    
+    outTable = threshTable.bboxes[kept]
     
-    return outTable
+    return outTable.tolist()
 
             
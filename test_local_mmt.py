@@ -0,0 +1,155 @@
+import cv2
+import numpy as np
+import pytest
+
+import local_mmt
+
+
+def _scene():
+    '''
+    Noisy image with 2 templates pasted at well separated locations, some of them across the seams of small strips
+    '''
+    rng   = np.random.default_rng(0)
+    image = rng.integers(0, 256, (240, 200), dtype=np.uint8)
+
+    templateA = rng.integers(0, 256, (12, 15), dtype=np.uint8)
+    templateB = rng.integers(0, 256, (9, 9),   dtype=np.uint8)
+
+    for x, y in [(10, 5), (120, 27), (60, 61), (150, 130)]:
+        image[y:y+12, x:x+15] = templateA
+
+    for x, y in [(90, 10), (20, 100), (170, 200)]:
+        image[y:y+9, x:x+9] = templateB
+
+    return [("A", templateA), ("B", templateB)], image
+
+
+@pytest.mark.parametrize("method", [cv2.TM_SQDIFF_NORMED, cv2.TM_CCORR_NORMED, cv2.TM_CCOEFF_NORMED])
+@pytest.mark.parametrize("N_object", [1, float("inf")])
+def test_strips_match_full_score_map(monkeypatch, method, N_object):
+    listTemplates, image = _scene()
+    score_threshold = 0.1 if method==cv2.TM_SQDIFF_NORMED else 0.9
+
+    full = local_mmt.findMatches(listTemplates, image, method, N_object, score_threshold)
+
+    monkeypatch.setattr(local_mmt, "_maxScorePixels", 5000) # strips of 27 rows
+    strips = local_mmt.findMatches(listTemplates, image, method, N_object, score_threshold)
+
+    assert len(full) == (2 if N_object==1 else 7) # N_object is per template
+    np.testing.assert_array_equal(strips.names,  full.names)
+    np.testing.assert_array_equal(strips.bboxes, full.bboxes)
+    np.testing.assert_allclose(strips.scores, full.scores, atol=1e-4)
+
+
+def test_strips_find_local_extrema_on_seams(monkeypatch):
+    # Many local maxima on a smooth score map, including on the seams : each one must be reported exactly once,
+    # as the local maxima of the score map assembled from the strips (the strips round scores differently than the full map)
+    rng   = np.random.default_rng(1)
+    image = cv2.GaussianBlur(rng.integers(0, 256, (120, 90), dtype=np.uint8), (0, 0), 3)
+    template = image[40:47, 30:37].copy()
+
+    for budget in (2*84, 3*84, 5000):
+        monkeypatch.setattr(local_mmt, "_maxScorePixels", budget)
+
+        strips = local_mmt._iterScoreStrips_(template, image, cv2.TM_CCORR_NORMED, 7, 7)
+        scoreMap = np.concatenate([corrMap[ownStart:ownEnd].copy() for corrMap, _, _, (ownStart, ownEnd) in strips])
+        expected = {(x, y, 7, 7) for y, x in local_mmt._findLocalMax_(scoreMap, 0.5).tolist()}
+
+        hits = local_mmt.findMatches([("T", template)], image, cv2.TM_CCORR_NORMED, float("inf"), 0.5)
+        assert len(hits) == len(expected) > 20
+        assert set(map(tuple, hits.bboxes.tolist())) == expected
+
+
+def test_computeIoU():
+    assert local_mmt.computeIoU((0, 0, 10, 10), (20, 20, 10, 10)) == 0
+    assert local_mmt.computeIoU((0, 0, 10, 10), (5, 0, 10, 10)) == pytest.approx(50/150)
+    assert local_mmt.computeIoU((0, 0, 100, 100), (10, 10, 20, 20)) == 1 # included
+    assert local_mmt.computeIoU((10, 10, 20, 20), (0, 0, 100, 100)) == 1
+
+
+def test_NMS_rejects_included_boxes():
+    hits = local_mmt.Hits(np.array(["A", "A", "A"], dtype=object),
+                          np.array([(0, 0, 100, 100), (10, 10, 20, 20), (200, 0, 20, 20)]),
+                          np.array([0.9, 0.8, 0.7]))
+
+    assert local_mmt.NMS(hits, maxOverlap=0.25) == [[0, 0, 100, 100], [200, 0, 20, 20]]
+
+
+def test_executor_kept_across_calls(monkeypatch):
+    monkeypatch.setattr(local_mmt, "_executor", None)
+    monkeypatch.setattr(local_mmt, "_executorWorkers", 0)
+    monkeypatch.setattr(local_mmt.os, "cpu_count", lambda: 4)
+    monkeypatch.setattr(local_mmt.cv2, "getNumThreads", lambda: 1)
+
+    listTemplates, image = _scene()
+    hits = local_mmt.findMatches(listTemplates, image, cv2.TM_CCOEFF_NORMED, float("inf"), 0.9)
+
+    executor = local_mmt._executor
+    try:
+        assert executor is not None and local_mmt._executorWorkers == 4
+
+        hits2 = local_mmt.findMatches(listTemplates, image, cv2.TM_CCOEFF_NORMED, float("inf"), 0.9)
+        assert local_mmt._executor is executor
+        np.testing.assert_array_equal(hits2.bboxes, hits.bboxes)
+
+        monkeypatch.setattr(local_mmt.cv2, "getNumThreads", lambda: 4) # OpenCV already uses all the CPUs
+        assert local_mmt._getExecutor_() is None
+
+    finally:
+        if executor is not None: executor.shutdown()
+
+
+def test_Hits_indexing():
+    hits = local_mmt.Hits(["A", "B"], [(0, 0, 10, 10), (5, 5, 10, 10)], [0.9, 0.8])
+
+    first = hits[0]
+    assert len(first) == 1
+    assert first.names.tolist() == ["A"] and first.bboxes.tolist() == [[0, 0, 10, 10]]
+    assert len(hits[np.int64(-1)]) == 1
+    assert len(hits[hits.scores > 0.85]) == 1
+
+    assert hits != local_mmt.Hits(["A", "B"], [(0, 0, 10, 10), (5, 5, 10, 10)], [0.9, 0.8]) # identity, not arrays comparison
+    assert hits == hits
+
+
+def test_free_buffers_bounded():
+    rng   = np.random.default_rng(2)
+    image = rng.integers(0, 256, (200, 200), dtype=np.uint8)
+    listTemplates = [(str(size), image[:size, :size].copy()) for size in range(5, 25)]
+
+    local_mmt.findMatches(listTemplates, image, cv2.TM_CCOEFF_NORMED, float("inf"), 0.9)
+    assert len(local_mmt._freeBuffers) == local_mmt._maxFreeBuffers
+
+    # the buffers kept are the last used ones, reused by the next image
+    lastShape = list(local_mmt._freeBuffers)[-1]
+    buffer    = local_mmt._freeBuffers[lastShape]
+    local_mmt.findMatches(listTemplates[-1:], image, cv2.TM_CCOEFF_NORMED, float("inf"), 0.9)
+    assert local_mmt._freeBuffers[lastShape] is buffer
+
+
+class _FakeGpuMat:
+    '''Stand-in for a cv2.cuda_GpuMat holding a score map, recording the rows downloaded'''
+    def __init__(self, array, downloads):
+        self.array, self.downloads = array, downloads
+
+    def rowRange(self, start, end):
+        return _FakeGpuMat(self.array[start:end], self.downloads)
+
+    def download(self):
+        self.downloads.append(self.array.shape)
+        return self.array.copy()
+
+
+def test_gpu_score_map_downloaded_by_strips(monkeypatch):
+    listTemplates, image = _scene()
+    template  = listTemplates[0][1]
+    downloads = []
+    monkeypatch.setattr(local_mmt, "_computeScoreMapCuda_",
+                        lambda template, imageGpu, method: _FakeGpuMat(cv2.matchTemplate(image, template, method), downloads))
+    monkeypatch.setattr(local_mmt, "_maxScorePixels", 5000)
+
+    scoreMap = np.concatenate([corrMap[ownStart:ownEnd].copy() for corrMap, _, _, (ownStart, ownEnd)
+                               in local_mmt._iterScoreStrips_(template, image, cv2.TM_CCOEFF_NORMED, 12, 15, imageGpu=object())])
+
+    np.testing.assert_array_equal(scoreMap, cv2.matchTemplate(image, template, cv2.TM_CCOEFF_NORMED))
+    assert max(height*width for height, width in downloads) <= 5000